@@ -2,20 +2,36 @@
 Module containing the base classes for caching mechanisms.
 
 This module provides an abstract base class `Cache` that defines the interface
-for caching mechanisms. It also contains a dictionary `DEFAULT_CACHE` that
-represents the default values for the cache.
+for caching mechanisms. It also contains a function `default_cache` that
+returns the default values for the cache.
 
 Classes:
     Cache: Abstract base class for caching mechanisms.
+
+Functions:
+    default_cache: Returns a new dictionary with the default values for the cache.
 """
 
+from __future__ import annotations
+
 from abc import ABC, abstractmethod
 
-DEFAULT_CACHE = {
-    "etag": None,
-    "ips_v4": [],
-    "ips_v6": []
-}
+
+def default_cache() -> dict:
+    """
+    Get a new dictionary with the default values for the cache.
+
+    A new dictionary is returned on every call so that its lists are never
+    shared between caches.
+
+    Returns:
+        dict: The default values for the cache.
+    """
+    return {
+        "etag": None,
+        "ips_v4": [],
+        "ips_v6": []
+    }
 
 
 class Cache(ABC):
@@ -61,6 +77,44 @@ class Cache(ABC):
             None
         """
 
+    @abstractmethod
+    def flush(self) -> None:
+        """
+        Persist the values set in the cache since the last flush.
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def refresh(self) -> None:
+        """
+        Pick up the changes made to the stored cache since it was last read, e.g. by another
+        process. Values set since the last flush are kept.
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def get_age(self) -> float | None:
+        """
+        Get the number of seconds since the cache was last written or touched, as of the last
+        refresh, read or write of the cache.
+
+        Returns:
+            float | None: The age of the cache in seconds, or None if it was never written.
+        """
+
+    @abstractmethod
+    def touch(self) -> None:
+        """
+        Reset the age of the cache without changing its values.
+
+        Returns:
+            None
+        """
+
     def get_etag(self) -> str | None:
         """
         Get the ETag value associated with the "etag" key from the cache.
@@ -90,7 +144,7 @@ class Cache(ABC):
             set[str]: A set of IPv4 addresses if the "ips_v4" key exists in the cache,
                       otherwise an empty set.
         """
-        return self.get("ips_v4") if self.has("ips_v4") else []
+        return self.get("ips_v4") if self.has("ips_v4") else set()
 
     def set_ipv4_addresses(self, ips: set[str]) -> None:
         """
@@ -112,7 +166,7 @@ class Cache(ABC):
             set[str]: A set of IPv6 addresses if the "ips_v6" key exists in the cache,
                       otherwise an empty set.
         """
-        return self.get("ips_v6") if self.has("ips_v6") else []
+        return self.get("ips_v6") if self.has("ips_v6") else set()
 
     def set_ipv6_addresses(self, ips: set[str]) -> None:
         """
@@ -6,13 +6,40 @@ The cache data is stored in JSON format in the file located at the path
 provided in the constructor.
 """
 
-from json import load as json_load, dump as json_dump
-from os.path import exists as path_exists
-
-from cache.base import DEFAULT_CACHE, Cache
+from atexit import register as atexit_register
+from mmap import ACCESS_READ, PAGESIZE, mmap
+from os import close, fchmod, fstat, fsync, replace, stat, unlink, utime, write
+from os.path import dirname
+from tempfile import mkstemp
+from time import time, time_ns
+from typing import BinaryIO
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as _json_loads, dumps as _json_dumps
+
+    def json_loads(data: bytes | memoryview):
+        """
+        Deserialize the given JSON bytes, also accepting a memoryview like orjson does.
+        """
+        return _json_loads(bytes(data))
+
+    def json_dumps(obj, default=None) -> bytes:
+        """
+        Serialize the given object to JSON encoded as UTF-8 bytes, like orjson does.
+        """
+        return _json_dumps(obj, default=default).encode('utf-8')
+
+from cache.base import Cache, default_cache
 
 DEFAULT_PATH = "/tmp/cloudflare_ips.json"
 
+# mkstemp creates the temporary file as 0600, which the rename would give to the cache file.
+FILE_MODE = 0o644
+
+IP_KEYS = ("ips_v4", "ips_v6")
+
 
 class FileCache(Cache):
     """
@@ -25,32 +52,110 @@ class FileCache(Cache):
 
     def __init__(self, path: str = DEFAULT_PATH) -> None:
         self.path = path
-        self.cache = {}
-        self.__load()
+        self.cache: dict | None = None
+        self._dirty = False
+
+        # Modification time of the file when it was last refreshed, read or written,
+        # None if it did not exist.
+        self._mtime_ns: int | None = None
+
+        atexit_register(self.flush)
+
+    @staticmethod
+    def __convert_ips(cache: dict) -> dict:
+        # JSON has no sets, so the addresses are converted once here instead of on every read.
+        for key in IP_KEYS:
+            cache[key] = set(cache.get(key, []))
+
+        return cache
+
+    @staticmethod
+    def __read(file: BinaryIO, size: int) -> dict:
+        # Mapping only pays off once the file spans more than a page; smaller files are read.
+        if size < PAGESIZE:
+            return FileCache.__convert_ips(json_loads(file.read()))
+
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as data, memoryview(data) as view:
+            return FileCache.__convert_ips(json_loads(view))
+
+    def __load(self) -> dict:
+        if self.cache is None:
+            try:
+                with open(self.path, 'rb') as file:
+                    file_stat = fstat(file.fileno())
+                    self.cache = FileCache.__read(file, file_stat.st_size)
+                    self._mtime_ns = file_stat.st_mtime_ns
+            except FileNotFoundError:
+                self.cache = FileCache.__convert_ips(default_cache())
+                self._mtime_ns = None
+
+        return self.cache
+
+    def refresh(self) -> None:
+        try:
+            mtime_ns = stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
 
-    def __init(self) -> None:
-        with open(self.path, 'w', encoding='utf-8') as file:
-            json_dump(DEFAULT_CACHE, file)
+        # An unchanged file is not parsed again; unsaved changes are kept until they are flushed.
+        if mtime_ns != self._mtime_ns and not self._dirty:
+            self.cache = None
 
-    def __load(self) -> None:
-        if not path_exists(self.path):
-            self.__init()
+        self._mtime_ns = mtime_ns
 
-        with open(self.path, 'r', encoding='utf-8') as file:
-            self.cache = json_load(file)
+    def flush(self) -> None:
+        if not self._dirty:
+            return
 
-    def _save(self) -> None:
-        with open(self.path, 'w', encoding='utf-8') as file:
-            json_dump(self.cache, file)
+        data = memoryview(json_dumps(self.cache, default=sorted))
+
+        # Write to a sibling temporary file and rename it so the cache file is never torn.
+        fd, tmp_path = mkstemp(dir=dirname(self.path) or '.')
+
+        try:
+            try:
+                fchmod(fd, FILE_MODE)
+
+                while data:
+                    data = data[write(fd, data):]
+
+                # The data must be on disk before the rename makes it the cache file.
+                fsync(fd)
+                mtime_ns = fstat(fd).st_mtime_ns
+            finally:
+                close(fd)
+
+            replace(tmp_path, self.path)
+        except OSError:
+            unlink(tmp_path)
+            raise
+
+        self._mtime_ns = mtime_ns
+        self._dirty = False
+
+    def get_age(self) -> float | None:
+        if self._mtime_ns is None:
+            return None
+
+        return time() - self._mtime_ns / 1e9
+
+    def touch(self) -> None:
+        mtime_ns = time_ns()
+
+        try:
+            utime(self.path, ns=(mtime_ns, mtime_ns))
+        except FileNotFoundError:
+            return
+
+        # Only the mtime changed, so the loaded data stays valid under the new one.
+        self._mtime_ns = mtime_ns
 
     def has(self, key: str) -> bool:
-        return key in self.cache
+        return key in self.__load()
 
     def get(self, key: str) -> str | set[str]:
-        if not self.has(key):
-            raise KeyError
-
-        return self.cache[key]
+        return self.__load()[key]
 
     def set(self, key: str, value: str | set[str]) -> None:
-        self.cache[key] = value
+        self.__load()[key] = value
+        self._dirty = True
@@ -5,7 +5,59 @@ This module contains the CloudFlare class, which is responsible for retrieving
 the IPv4 and IPv6 addresses from the Cloudflare API.
 """
 
-from requests import request, HTTPError
+from gzip import BadGzipFile, GzipFile
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from ipaddress import ip_network
+from sys import stderr
+from time import sleep
+from typing import BinaryIO
+from urllib.parse import urlsplit
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from ijson import JSONError as StreamJSONError, ObjectBuilder, parse as json_parse
+except ImportError:
+    json_parse = None
+    StreamJSONError = ValueError
+
+# Errors raised while decompressing or decoding a response body that is truncated or not JSON.
+DECODE_ERRORS = (BadGzipFile, EOFError, ValueError, StreamJSONError)
+
+
+def normalize_ips(ips: list[str], version: int) -> set[str]:
+    """
+    Normalizes the given IP networks, dropping duplicates and invalid entries.
+
+    Each entry is parsed with `ipaddress.ip_network` (host bits are allowed and masked) and
+    converted back to its canonical string, so equal networks always compare equal. Invalid
+    entries are reported to stderr and skipped, instead of failing a firewall command later.
+
+    Args:
+        ips (list[str]): The IP networks to normalize.
+        version (int): The IP version (4 or 6) the networks must have.
+
+    Returns:
+        set[str]: The normalized IP networks.
+    """
+    normalized: set[str] = set()
+
+    for ip in ips:
+        try:
+            network = ip_network(str(ip).strip(), strict=False)
+        except ValueError:
+            network = None
+
+        if network is None or network.version != version:
+            print(f"Skipping invalid IPv{version} network {ip!r}", file=stderr)
+            continue
+
+        normalized.add(str(network))
+
+    return normalized
 
 
 # pylint: disable=R0903
@@ -19,49 +71,150 @@ class CloudFlare:
 
     BASE_ENDPOINT = "https://api.cloudflare.com/client/v4/"
 
-    def get_ips(self) -> tuple[list[str], list[str], str]:
+    # http.client sends no User-Agent of its own, so the client identifies itself explicitly.
+    HEADERS = {
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip",
+        "User-Agent": "cloudflare-firewall-rules",
+    }
+
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.2
+    TIMEOUT = 30
+
+    def __init__(self) -> None:
+        # A single connection is kept alive (with its TLS session) between requests.
+        self._connection: HTTPConnection | None = None
+
+    def __get_connection(self) -> HTTPConnection:
+        if self._connection is None:
+            url = urlsplit(self.BASE_ENDPOINT)
+            connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+            self._connection = connection_class(url.netloc, timeout=self.TIMEOUT)
+
+        return self._connection
+
+    def __request(self, endpoint: str, headers: dict[str, str]) -> HTTPResponse:
+        path = urlsplit(f"{self.BASE_ENDPOINT}{endpoint}").path
+
+        attempt = 0
+
+        while True:
+            connection = self.__get_connection()
+
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection.getresponse()
+            except (OSError, HTTPException):
+                connection.close()
+
+                if attempt == self.RETRIES:
+                    raise
+
+                sleep(self.BACKOFF_FACTOR * 2 ** attempt)
+                attempt += 1
+
+    @staticmethod
+    def __read_ips_response(body: BinaryIO) -> dict:
+        if json_parse is None:
+            return json_loads(body.read())
+
+        # Stream the body and only keep the fields that are used, instead of the whole document.
+        data = {"errors": [], "result": {"ipv4_cidrs": [], "ipv6_cidrs": []}}
+        result = data["result"]
+        error: ObjectBuilder | None = None
+
+        for prefix, event, value in json_parse(body):
+            if prefix == "success":
+                data["success"] = value
+            elif prefix == "errors.item" and event in ("start_map", "start_array"):
+                # Each error is built whole, so it is reported as by the json fallback.
+                error = ObjectBuilder()
+                error.event(event, value)
+            elif error is not None and prefix.startswith("errors.item"):
+                error.event(event, value)
+
+                if prefix == "errors.item" and event in ("end_map", "end_array"):
+                    data["errors"].append(error.value)
+                    error = None
+            elif prefix == "errors.item":
+                data["errors"].append(value)
+            elif prefix == "result.etag":
+                result["etag"] = value
+            elif prefix == "result.ipv4_cidrs.item":
+                result["ipv4_cidrs"].append(value)
+            elif prefix == "result.ipv6_cidrs.item":
+                result["ipv6_cidrs"].append(value)
+
+        return data
+
+    def get_ips(self, etag: str | None = None) -> tuple[set[str], set[str], str] | None:
         """
         Retrieves the IPv4 and IPv6 addresses from the Cloudflare API.
 
+        Args:
+            etag (str | None): The ETag of a previous response. When given, the request
+                is made conditional and the addresses are only returned if they changed.
+
         Returns:
-            tuple[list[str], list[str], str]: A tuple containing three elements:
-                - A list of IPv4 addresses as strings.
-                - A list of IPv6 addresses as strings.
-                - The ETag of the response as a string.
+            tuple[set[str], set[str], str] | None: A tuple containing three elements:
+                - A set of IPv4 addresses as normalized strings.
+                - A set of IPv6 addresses as normalized strings.
+                - The ETag header of the response, as a quoted entity tag.
+            None is returned if the addresses did not change since the given ETag.
 
         Raises:
-            HTTPError: If the request fails or the response status code is not 200.
+            HTTPException: If the request fails, the response status code is not 200 or its body
+                is not the expected JSON.
 
         Example:
             >>> cloudflare = CloudFlare()
             >>> ips_v4, ips_v6, etag = cloudflare.get_ips()
             >>> print(ips_v4)
-            ['192.0.2.1', '192.0.2.2']
+            {'192.0.2.0/24', '198.51.100.0/24'}
             >>> print(ips_v6)
-            ['2001:db8::1', '2001:db8::2']
+            {'2001:db8::/32'}
             >>> print(etag)
-            'abc123'
+            '"abc123"'
         """
-        headers = {"Content-Type": "application/json"}
-
-        response = request(
-            "GET", f"{self.BASE_ENDPOINT}ips", headers=headers, timeout=30)
-
-        if not response.ok or response.status_code != 200:
-            raise HTTPError(
-                f"Request failed with status code {response.status_code}"
-                f" and message {response.text}"
-            )
-
-        data: dict = response.json()
-
-        if not data.get("success"):
-            raise HTTPError(f"Request failed with errors {data.get('errors')}")
-
-        result: dict = data.get("result")
-
-        etag: str = result.get("etag")
-        ips_v4: list[str] = result.get("ipv4_cidrs", [])
-        ips_v6: list[str] = result.get("ipv6_cidrs", [])
+        headers = {**self.HEADERS, "If-None-Match": etag} if etag else self.HEADERS
+
+        response = self.__request("ips", headers)
+        body: BinaryIO = response
+
+        if response.getheader("Content-Encoding") == "gzip":
+            body = GzipFile(fileobj=response)
+
+        try:
+            if response.status == 304:
+                return None
+
+            if response.status != 200:
+                raise HTTPException(
+                    f"Request failed with status code {response.status}"
+                    f" and message {body.read().decode(errors='replace')}"
+                )
+
+            data: dict = CloudFlare.__read_ips_response(body)
+        except DECODE_ERRORS as error:
+            raise HTTPException(f"Request failed with an invalid response body: {error}") from error
+        finally:
+            # The body has to be fully read before the connection can be reused.
+            response.read()
+
+        try:
+            if not data.get("success"):
+                raise HTTPException(f"Request failed with errors {data.get('errors')}")
+
+            result: dict = data["result"]
+
+            # The ETag header is what the server compares If-None-Match against; the etag field of
+            # the body is unquoted, so it is only quoted into an entity tag when the header is
+            # missing.
+            etag: str = response.getheader("ETag") or f'"{result["etag"]}"'
+            ips_v4: set[str] = normalize_ips(result.get("ipv4_cidrs") or [], 4)
+            ips_v6: set[str] = normalize_ips(result.get("ipv6_cidrs") or [], 6)
+        except (AttributeError, KeyError, TypeError) as error:
+            raise HTTPException(f"Request failed with an unexpected response: {error!r}") from error
 
         return ips_v4, ips_v6, etag
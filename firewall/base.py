@@ -59,6 +59,18 @@ class Firewall(ABC):
             bool: True if a rule exists for the given IP address and IP version, False otherwise.
         """
 
+    @abstractmethod
+    def get_allowed_ips(self, ip_version: IPVersion) -> set[str]:
+        """
+        Get the IP addresses that currently have allow rules in the firewall.
+
+        Args:
+            ip_version (IPVersion): The IP version of the addresses to get.
+
+        Returns:
+            set[str]: The IP addresses for which all allow rules exist.
+        """
+
     @abstractmethod
     def save_allow_rule(self, ip_address: str, ip_version: IPVersion) -> bool:
         """
@@ -5,11 +5,76 @@ and represents a syncable firewall using firewalld.
 This module provides a class Firewalld that provides methods to manage firewall rules.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from subprocess import run, CalledProcessError
+from os import cpu_count, environ, geteuid, sysconf
+from shlex import join as shlex_join
+from subprocess import DEVNULL, PIPE, CalledProcessError, CompletedProcess, run
+from sys import stderr
 
 from firewall.base import IPVersion, SyncableFirewall
 
+# Half of the kernel limit is left for the environment of the child process.
+ARGS_MAX_SIZE = sysconf("SC_ARG_MAX") // 2
+
+MAX_WORKERS = min(8, cpu_count() or 1)
+
+# When set, the firewall-cmd (and nft) commands are printed to stderr before being run.
+DEBUG = bool(environ.get("FW_DEBUG"))
+
+RULE_FAMILIES = {
+    IPVersion.V4: "ipv4",
+    IPVersion.V6: "ipv6",
+}
+
+
+class CommandError(CalledProcessError):
+    """
+    Exception raised when a firewall command exits with a non-zero status.
+
+    Unlike CalledProcessError, its message includes what the command printed to stderr.
+    """
+
+    def __str__(self) -> str:
+        message = super().__str__()
+        output = self.stderr
+
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+
+        output = (output or "").strip()
+
+        return f"{message} {output}" if output else message
+
+
+def run_cmd(cmd_name: str, args: str | list[str], **kwargs) -> CompletedProcess:
+    """
+    Run a firewall command, checking its exit status.
+
+    Args:
+        cmd_name (str): The name of the command, e.g. "firewall-cmd".
+        args (str | list[str]): The arguments of the command.
+        **kwargs: The keyword arguments passed to subprocess.run.
+
+    Returns:
+        CompletedProcess: The completed process.
+
+    Raises:
+        CommandError: If the command exits with a non-zero status.
+    """
+    if isinstance(args, str):
+        args = [args]
+
+    cmd = [cmd_name] + args
+
+    if DEBUG:
+        print(shlex_join(cmd), file=stderr)
+
+    try:
+        return run(cmd, check=True, **kwargs)
+    except CalledProcessError as error:
+        raise CommandError(error.returncode, error.cmd, error.output, error.stderr) from error
+
 
 class Operation(Enum):
     """
@@ -36,79 +101,222 @@ class Firewalld(SyncableFirewall):
         is_permanent: bool = True,
         zone: str = "public",
     ):
+        if geteuid() != 0:
+            raise PermissionError("firewall-cmd requires root privileges")
+
         super().__init__(allowed_ports=allowed_ports, ip_versions=ip_versions)
 
         self.is_permanent = is_permanent
         self.zone = zone
+        # The rich rules of the permanent (True) and runtime (False) configurations.
+        self._existing_rules: dict[bool, frozenset[str]] = {}
+        self._reload_required = False
 
-    @staticmethod
-    def __run_cmd(args: str | list[str]) -> None:
-        if isinstance(args, str):
-            args = [args]
+        # Only the source address changes between rules, so the rest is formatted once.
+        self._rule_templates: dict[IPVersion, list[str]] = {
+            ip_version: [Firewalld.__generate_rule_template(ip_version, port)
+                         for port in self.allowed_ports]
+            for ip_version in IPVersion
+        }
+
+        # With a single allowed port (the common case) there is one template per IP version.
+        self._single_rule_templates: dict[IPVersion, str] | None = None
 
-        result = run(['firewall-cmd'] + args, user='root',
-                     check=True, capture_output=True, text=True)
+        if len(self.allowed_ports) == 1:
+            self._single_rule_templates = {
+                ip_version: templates[0] for ip_version, templates in self._rule_templates.items()
+            }
+
+    @staticmethod
+    def _run_cmd_silent(args: str | list[str]) -> None:
+        # The output is not needed: only stderr is kept for the error message.
+        run_cmd('firewall-cmd', args, stdout=DEVNULL, stderr=PIPE)
 
-        if result.returncode != 0:
-            raise CalledProcessError(
-                result.returncode, result.args, output=result.stdout, stderr=result.stderr)
+    @staticmethod
+    def _run_cmd_capture(args: str | list[str]) -> str:
+        return run_cmd('firewall-cmd', args, capture_output=True, text=True).stdout
 
-    def __run_rule_cmd(self, operation: Operation, rule: str) -> None:
+    def _get_zone_args(self, is_permanent: bool) -> list[str]:
         args = []
 
-        if self.is_permanent:
+        if is_permanent:
             args.append("--permanent")
 
         args.append("--zone=" + self.zone)
-        args.append(f"--{operation.value}-rich-rule={rule}")
 
-        Firewalld.__run_cmd(args)
+        return args
+
+    def _get_configs(self) -> list[bool]:
+        # Permanent changes are also applied to the runtime configuration, so that they take
+        # effect without reloading firewalld, unless a reload is required anyway.
+        if self.is_permanent and not self._reload_required:
+            return [True, False]
+
+        return [self.is_permanent]
+
+    def __load_config_rules(self, is_permanent: bool) -> frozenset[str]:
+        if is_permanent not in self._existing_rules:
+            output = Firewalld._run_cmd_capture(
+                self._get_zone_args(is_permanent) + ["--list-rich-rules"])
+            self._existing_rules[is_permanent] = frozenset(
+                line.strip() for line in output.splitlines() if line.strip())
+
+        return self._existing_rules[is_permanent]
+
+    def _load_existing_rules(self) -> frozenset[str]:
+        """
+        Get the rich rules currently configured in the zone.
+
+        The rules are listed with a single firewall-cmd call per configuration and kept in
+        memory, updated with the changes made through this instance. When permanent changes
+        are also applied at runtime, only the rules present in both configurations are
+        returned, so a rule missing from either one is applied again.
+
+        Returns:
+            frozenset[str]: The rich rules of the zone.
+        """
+        configs = self._get_configs()
+        existing_rules = self.__load_config_rules(configs[0])
+
+        for is_permanent in configs[1:]:
+            existing_rules = existing_rules & self.__load_config_rules(is_permanent)
+
+        return existing_rules
 
     @staticmethod
-    def __generate_rule(ip_address: str, ip_version: IPVersion, port: int) -> str:
-        family = "ipv6" if ip_version == IPVersion.V6 else "ipv4"
+    def __chunk_args(args: list[str], reserved_size: int) -> list[list[str]]:
+        chunks: list[list[str]] = []
+        chunk: list[str] = []
+        chunk_size = reserved_size
+
+        for arg in args:
+            # Each argument costs its bytes, the NUL terminator and the argv pointer.
+            arg_size = len(arg.encode()) + 1 + 8
+
+            if chunk and chunk_size + arg_size > ARGS_MAX_SIZE:
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = reserved_size
+
+            chunk.append(arg)
+            chunk_size += arg_size
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def _run_rule_cmds(self, operation: Operation, rules: list[str]) -> None:
+        cmds: list[list[str]] = []
+        updated_rules: dict[bool, frozenset[str]] = {}
+
+        # Each configuration is compared separately, so one that drifted from the other
+        # (e.g. after a failed runtime command) is repaired by the next run.
+        for is_permanent in self._get_configs():
+            existing_rules = self.__load_config_rules(is_permanent)
+
+            if operation == Operation.SAVE:
+                pending_rules = [rule for rule in rules if rule not in existing_rules]
+                updated_rules[is_permanent] = existing_rules.union(pending_rules)
+            else:
+                pending_rules = [rule for rule in rules if rule in existing_rules]
+                updated_rules[is_permanent] = existing_rules.difference(pending_rules)
+
+            if not pending_rules:
+                continue
+
+            args = self._get_zone_args(is_permanent)
+            rule_args = [f"--{operation.value}-rich-rule={rule}" for rule in pending_rules]
+            reserved_size = sum(len(arg.encode()) + 1 + 8 for arg in ['firewall-cmd'] + args)
 
+            cmds.extend(args + chunk for chunk in Firewalld.__chunk_args(rule_args, reserved_size))
+
+        if not cmds:
+            return
+
+        # If a command fails, part of the rules may have been applied: the zone is listed again.
+        self._existing_rules = {}
+
+        if len(cmds) == 1:
+            Firewalld._run_cmd_silent(cmds[0])
+        else:
+            # The commands are independent, so their subprocesses can run concurrently.
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(cmds))) as executor:
+                list(executor.map(Firewalld._run_cmd_silent, cmds))
+
+        self._existing_rules = updated_rules
+
+    @staticmethod
+    def __generate_rule_template(ip_version: IPVersion, port: int) -> str:
         return (
-            f'rule family="{family}" '
-            f'source address="{ip_address.strip()}" '
+            f'rule family="{RULE_FAMILIES[ip_version]}" '
+            'source address="%s" '
             f'port port="{port}" '
-            f'protocol="tcp" '
+            'protocol="tcp" '
             "accept"
         )
 
-    def __generate_rules(self, ip_address: str, ip_version: IPVersion) -> set[str]:
-        rules: set[str] = set()
+    def __generate_rules(self, ip_address: str, ip_version: IPVersion) -> list[str]:
+        if self._single_rule_templates is not None:
+            return [self._single_rule_templates[ip_version] % ip_address]
 
-        for port in self.allowed_ports:
-            rules.add(self.__generate_rule(ip_address=ip_address,
-                      ip_version=ip_version, port=port))
-
-        return rules
+        return [template % ip_address for template in self._rule_templates[ip_version]]
 
     def is_rule_existing(self, ip_address: str, ip_version: IPVersion) -> bool:
-        rules = self.__generate_rules(ip_address, ip_version)
+        existing_rules = self._load_existing_rules()
 
-        for rule in rules:
-            self.__run_cmd(["--query-rich-rule", rule])
+        return all(rule in existing_rules
+                   for rule in self.__generate_rules(ip_address, ip_version))
 
-        return True
+    def get_allowed_ips(self, ip_version: IPVersion) -> set[str]:
+        existing_rules = self._load_existing_rules()
+        allowed_ips: set[str] | None = None
+
+        for template in self._rule_templates[ip_version]:
+            prefix, suffix = template.split("%s")
+            ips = {rule[len(prefix):-len(suffix)] for rule in existing_rules
+                   if rule.startswith(prefix) and rule.endswith(suffix)}
+
+            # An address is only allowed when the rules for all the ports exist.
+            allowed_ips = ips if allowed_ips is None else allowed_ips & ips
+
+        return allowed_ips or set()
 
     def save_allow_rule(self, ip_address: str, ip_version: IPVersion) -> bool:
-        rules = self.__generate_rules(ip_address, ip_version)
+        return self.save_allow_rules({ip_address}, ip_version)
+
+    def save_allow_rules(self, ip_address: set[str], ip_version: IPVersion) -> bool:
+        rules: list[str] = []
 
-        for rule in rules:
-            self.__run_rule_cmd(Operation.SAVE, rule)
+        # The rules that already exist are skipped for each configuration by _run_rule_cmds.
+        for ip in ip_address:
+            rules.extend(self.__generate_rules(ip, ip_version))
+
+        if rules:
+            self._run_rule_cmds(Operation.SAVE, rules)
 
         return True
 
     def delete_allow_rule(self, ip_address: str, ip_version: IPVersion) -> bool:
-        rules = self.__generate_rules(ip_address, ip_version)
+        return self.delete_allow_rules({ip_address}, ip_version)
+
+    def delete_allow_rules(self, ip_address: set[str], ip_version: IPVersion) -> bool:
+        rules: list[str] = []
 
-        for rule in rules:
-            self.__run_rule_cmd(Operation.DELETE, rule)
+        # The rules that do not exist are skipped for each configuration by _run_rule_cmds.
+        for ip in ip_address:
+            rules.extend(self.__generate_rules(ip, ip_version))
+
+        if rules:
+            self._run_rule_cmds(Operation.DELETE, rules)
 
         return True
 
     def sync(self) -> bool:
-        self.__run_cmd("--reload")
+        # The changes are already applied to the runtime configuration unless told otherwise.
+        if self._reload_required:
+            self._run_cmd_silent("--reload")
+            self._existing_rules = {}
+            self._reload_required = False
+
         return True
@@ -0,0 +1,281 @@
+"""
+This module contains the FirewalldIPSet class which is a subclass of Firewalld
+and represents a syncable firewall using firewalld ipsets.
+
+Instead of one rich rule per IP address, the IP addresses are stored as entries of
+a firewalld ipset per IP version, and a single rich rule per port references the ipset.
+
+When firewalld uses the nftables backend, the runtime contents of an ipset are replaced
+in a single nftables transaction.
+"""
+
+from ipaddress import ip_address as parse_ip_address, ip_network, summarize_address_range
+from json import loads as json_loads
+from os import unlink
+from subprocess import DEVNULL, PIPE
+from tempfile import NamedTemporaryFile
+
+from firewall.base import IPVersion
+from firewall.firewalld import RULE_FAMILIES, Firewalld, Operation, run_cmd
+
+FIREWALLD_CONF_PATH = "/etc/firewalld/firewalld.conf"
+
+# The nftables table in which firewalld creates the sets backing its ipsets.
+NFT_TABLE = "inet firewalld"
+
+
+def get_firewalld_backend(conf_path: str = FIREWALLD_CONF_PATH) -> str:
+    """
+    Get the backend used by firewalld from its configuration file.
+
+    Args:
+        conf_path (str): The path of the firewalld configuration file.
+
+    Returns:
+        str: The backend, either "nftables" (the firewalld default) or "iptables".
+    """
+    try:
+        with open(conf_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                key, _, value = line.strip().partition("=")
+
+                if key == "FirewallBackend":
+                    return value.strip()
+    except FileNotFoundError:
+        pass
+
+    return "nftables"
+
+
+class FirewalldIPSet(Firewalld):
+    """
+    Class representing a syncable firewall using firewalld ipsets.
+
+    The ipsets are hash-based, so adding or removing addresses does not touch the rich
+    rules and matching a packet does not depend on the number of addresses.
+    """
+
+    def __init__(
+        self,
+        allowed_ports: set[int],
+        ip_versions: set[IPVersion] = None,
+        is_permanent: bool = True,
+        zone: str = "public",
+        ipset_prefix: str = "cloudflare",
+    ):
+        super().__init__(allowed_ports=allowed_ports, ip_versions=ip_versions,
+                         is_permanent=is_permanent, zone=zone)
+
+        self.ipset_names = {
+            IPVersion.V4: f"{ipset_prefix}_v4",
+            IPVersion.V6: f"{ipset_prefix}_v6",
+        }
+
+        self._ipset_rules: dict[IPVersion, list[str]] = {
+            ip_version: [FirewalldIPSet.__generate_ipset_rule(name, ip_version, port)
+                         for port in self.allowed_ports]
+            for ip_version, name in self.ipset_names.items()
+        }
+
+        self._existing_ipsets: frozenset[str] | None = None
+        # The entries of each ipset in the permanent (True) and runtime (False) configurations.
+        self._entries: dict[tuple[IPVersion, bool], frozenset[str]] = {}
+        self._is_nftables = get_firewalld_backend() == "nftables"
+
+    @staticmethod
+    def __generate_ipset_rule(ipset_name: str, ip_version: IPVersion, port: int) -> str:
+        return (
+            f'rule family="{RULE_FAMILIES[ip_version]}" '
+            f'source ipset="{ipset_name}" '
+            f'port port="{port}" '
+            'protocol="tcp" '
+            "accept"
+        )
+
+    def __get_ipset_args(self, ip_version: IPVersion, is_permanent: bool) -> list[str]:
+        args = []
+
+        if is_permanent:
+            args.append("--permanent")
+
+        args.append("--ipset=" + self.ipset_names[ip_version])
+
+        return args
+
+    def __load_existing_ipsets(self) -> frozenset[str]:
+        if self._existing_ipsets is None:
+            output = Firewalld._run_cmd_capture(["--permanent", "--get-ipsets"])
+            self._existing_ipsets = frozenset(output.split())
+
+        return self._existing_ipsets
+
+    @staticmethod
+    def __parse_nft_element(element: str | dict) -> list[str]:
+        if isinstance(element, dict) and "elem" in element:
+            element = element["elem"]["val"]
+
+        if isinstance(element, dict) and "prefix" in element:
+            prefix = element["prefix"]
+            return [str(ip_network(f"{prefix['addr']}/{prefix['len']}"))]
+
+        if isinstance(element, dict) and "range" in element:
+            first, last = (parse_ip_address(address) for address in element["range"])
+            return [str(network) for network in summarize_address_range(first, last)]
+
+        return [str(ip_network(element))]
+
+    def __load_nft_entries(self, ip_version: IPVersion) -> frozenset[str]:
+        # Changes made with nft bypass firewalld, so the runtime entries are listed from nft too.
+        args = ["-j", "list", "set", *NFT_TABLE.split(), self.ipset_names[ip_version]]
+        output = run_cmd("nft", args, capture_output=True, text=True).stdout
+        entries: set[str] = set()
+
+        for item in json_loads(output)["nftables"]:
+            for element in item.get("set", {}).get("elem", []):
+                entries.update(FirewalldIPSet.__parse_nft_element(element))
+
+        return frozenset(entries)
+
+    def __load_entries(self, ip_version: IPVersion, is_permanent: bool) -> frozenset[str]:
+        key = (ip_version, is_permanent)
+
+        if key not in self._entries:
+            if self.ipset_names[ip_version] not in self.__load_existing_ipsets():
+                self._entries[key] = frozenset()
+            elif not is_permanent and self._is_nftables:
+                self._entries[key] = self.__load_nft_entries(ip_version)
+            else:
+                output = Firewalld._run_cmd_capture(
+                    self.__get_ipset_args(ip_version, is_permanent) + ["--get-entries"])
+                self._entries[key] = frozenset(output.split())
+
+        return self._entries[key]
+
+    def __load_allowed_entries(self, ip_version: IPVersion) -> frozenset[str]:
+        # As with the rich rules, an entry is only allowed when it exists in every configuration.
+        configs = self._get_configs()
+        entries = self.__load_entries(ip_version, configs[0])
+
+        for is_permanent in configs[1:]:
+            entries = entries & self.__load_entries(ip_version, is_permanent)
+
+        return entries
+
+    def __ensure_ipsets(self, ip_version: IPVersion) -> None:
+        # ipsets can only be created in the permanent configuration, so firewalld has to be
+        # reloaded for them (and anything referencing them) to exist at runtime. All of them are
+        # created at once, since a reload discards the runtime-only changes already applied.
+        missing_versions = [version for version in IPVersion
+                            if (version in self.ip_versions or version == ip_version)
+                            and self.ipset_names[version] not in self.__load_existing_ipsets()]
+
+        for version in missing_versions:
+            name = self.ipset_names[version]
+            family = "inet6" if version == IPVersion.V6 else "inet"
+
+            Firewalld._run_cmd_silent([
+                "--permanent", f"--new-ipset={name}", "--type=hash:net", f"--option=family={family}"
+            ])
+            self._existing_ipsets = self.__load_existing_ipsets().union({name})
+            self._reload_required = True
+
+        if missing_versions and not self.is_permanent:
+            self.sync()
+
+        existing_rules = self._load_existing_rules()
+        missing_rules = [rule for rule in self._ipset_rules[ip_version]
+                         if rule not in existing_rules]
+
+        if missing_rules:
+            self._run_rule_cmds(Operation.SAVE, missing_rules)
+
+    def __replace_nft_set(self, ip_version: IPVersion, entries: frozenset[str]) -> None:
+        name = self.ipset_names[ip_version]
+        script = f"flush set {NFT_TABLE} {name}\n"
+
+        if entries:
+            script += f"add element {NFT_TABLE} {name} {{ {', '.join(sorted(entries))} }}\n"
+
+        # nft applies the whole script as one transaction: the set is never seen half-updated.
+        run_cmd("nft", ["-f", "-"], input=script.encode(), stdout=DEVNULL, stderr=PIPE)
+
+    def __run_entries_file_cmd(
+        self, operation: Operation, ip_version: IPVersion, is_permanent: bool, ips: set[str]
+    ) -> None:
+        # The entries are passed through a file, so their number does not matter for ARG_MAX.
+        file = NamedTemporaryFile('w', encoding='utf-8', suffix='.txt', delete=False)
+        entries_arg = f"--{operation.value}-entries-from-file={file.name}"
+
+        try:
+            with file:
+                file.write("\n".join(ips) + "\n")
+
+            Firewalld._run_cmd_silent(
+                self.__get_ipset_args(ip_version, is_permanent) + [entries_arg])
+        finally:
+            unlink(file.name)
+
+    def __run_entries_cmds(
+        self, operation: Operation, ip_version: IPVersion, ips: set[str]
+    ) -> None:
+        # As with the rich rules, permanent changes are also applied at runtime, and each
+        # configuration is compared separately so that one that drifted is repaired.
+        for is_permanent in self._get_configs():
+            key = (ip_version, is_permanent)
+            entries = self.__load_entries(ip_version, is_permanent)
+
+            if operation == Operation.SAVE:
+                pending_ips = ips - entries
+                new_entries = entries.union(pending_ips)
+            else:
+                pending_ips = ips & entries
+                new_entries = entries.difference(pending_ips)
+
+            if not pending_ips:
+                continue
+
+            # If it fails, part of the entries may have been applied: they are listed again.
+            del self._entries[key]
+
+            if not is_permanent and self._is_nftables:
+                self.__replace_nft_set(ip_version, new_entries)
+            else:
+                self.__run_entries_file_cmd(operation, ip_version, is_permanent, pending_ips)
+
+            self._entries[key] = new_entries
+
+    def __has_ipset_rules(self, ip_version: IPVersion) -> bool:
+        existing_rules = self._load_existing_rules()
+
+        return all(rule in existing_rules for rule in self._ipset_rules[ip_version])
+
+    def is_rule_existing(self, ip_address: str, ip_version: IPVersion) -> bool:
+        return (ip_address in self.__load_allowed_entries(ip_version)
+                and self.__has_ipset_rules(ip_version))
+
+    def get_allowed_ips(self, ip_version: IPVersion) -> set[str]:
+        if not self.__has_ipset_rules(ip_version):
+            return set()
+
+        return set(self.__load_allowed_entries(ip_version))
+
+    def save_allow_rules(self, ip_address: set[str], ip_version: IPVersion) -> bool:
+        self.__ensure_ipsets(ip_version)
+
+        if ip_address:
+            self.__run_entries_cmds(Operation.SAVE, ip_version, set(ip_address))
+
+        return True
+
+    def delete_allow_rules(self, ip_address: set[str], ip_version: IPVersion) -> bool:
+        if ip_address:
+            self.__run_entries_cmds(Operation.DELETE, ip_version, set(ip_address))
+
+        return True
+
+    def sync(self) -> bool:
+        if self._reload_required:
+            self._existing_ipsets = None
+            self._entries = {}
+
+        return super().sync()
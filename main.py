@@ -4,21 +4,101 @@ This module contains the main entry point of the application.
 It manages the synchronization of firewall rules with the latest Cloudflare IP addresses.
 
 It retrieves the latest IPv4 and IPv6 addresses from the Cloudflare API and compares them with the
-cached IP addresses.
+IP addresses currently allowed by the firewall, so that only the addresses that changed are applied
+to the firewall. Only the addresses cached by a previous synchronization are ever removed.
 
-If the cached ETag is different from the latest ETag, it removes the old allow rules and adds the
-new allow rules.
+The cached ETag is sent with the request, so the API only returns the addresses when they changed.
+If they did, it removes the allow rules of the dropped addresses and adds allow rules for the new
+ones.
 
 The firewall rules are saved to the `firewalld` and synchronized.
 
-The latest ETag is cached for future comparisons.
+The latest ETag and addresses are cached for future comparisons.
+
+By default a single synchronization is made. With `--watch SECONDS`, the process keeps running and
+synchronizes periodically.
 """
 
+from argparse import ArgumentParser, ArgumentTypeError
+from http.client import HTTPException
+from math import isfinite
+from os import environ
+from subprocess import SubprocessError
+from sys import stderr
+from time import sleep
+
 from cache.base import Cache
 from cache.file_cache import FileCache
 from cloudflare.base import CloudFlare
 from firewall.base import Firewall, IPVersion, SyncableFirewall
 from firewall.firewalld import Firewalld
+from firewall.firewalld_ipset import FirewalldIPSet
+
+ALLOWED_PORTS = {443}
+
+FIREWALL_BACKENDS: dict[str, type[Firewalld]] = {
+    "rich-rule": Firewalld,
+    "ipset": FirewalldIPSet,
+}
+
+
+def get_cache_ttl() -> float:
+    """
+    Gets the number of seconds during which a synchronization is skipped after the previous one,
+    from the `CF_CACHE_TTL` environment variable (0, the default, disables it).
+
+    Returns:
+        float: The number of seconds.
+
+    Raises:
+        ValueError: If the environment variable is not a finite number greater than or equal to 0.
+    """
+    value = environ.get("CF_CACHE_TTL", "0")
+
+    try:
+        cache_ttl = float(value)
+    except ValueError:
+        cache_ttl = None
+
+    if cache_ttl is None or not isfinite(cache_ttl) or cache_ttl < 0:
+        raise ValueError(f"CF_CACHE_TTL must be a number of seconds of at least 0, got {value!r}")
+
+    return cache_ttl
+
+
+def get_firewall_backend() -> type[Firewalld]:
+    """
+    Gets the firewall class selected by the `CF_FIREWALL_BACKEND` environment variable.
+
+    Supported values are `rich-rule` (the default), which adds a rich rule per IP address, and
+    `ipset`, which stores the IP addresses in firewalld ipsets referenced by a single rich rule.
+
+    Returns:
+        type[Firewalld]: The firewall class.
+
+    Raises:
+        ValueError: If the environment variable has an unsupported value.
+    """
+    backend = environ.get("CF_FIREWALL_BACKEND", "rich-rule")
+
+    if backend not in FIREWALL_BACKENDS:
+        raise ValueError(
+            f"CF_FIREWALL_BACKEND must be one of {', '.join(FIREWALL_BACKENDS)}, got {backend!r}")
+
+    return FIREWALL_BACKENDS[backend]
+
+
+def create_firewall() -> Firewall:
+    """
+    Creates the firewall selected by the `CF_FIREWALL_BACKEND` environment variable.
+
+    Returns:
+        Firewall: The firewall allowing traffic on the allowed ports.
+
+    Raises:
+        ValueError: If the environment variable has an unsupported value.
+    """
+    return get_firewall_backend()(ALLOWED_PORTS)
 
 
 def remove_old_allow_rules(ipv4: set[str], ipv6: set[str], firewall: Firewall) -> bool:
@@ -60,58 +140,165 @@ def add_new_allow_rules(ipv4: set[str], ipv6: set[str], firewall: Firewall) -> b
     if not firewall.save_allow_rules(ipv6, IPVersion.V6):
         return False
 
-    if issubclass(type(firewall), SyncableFirewall):
-        syncable_firewall: SyncableFirewall = firewall
-        return syncable_firewall.sync()
+    if isinstance(firewall, SyncableFirewall):
+        return firewall.sync()
 
     return True
 
 
-def main():
+def sync_cloudflare_ips(cache: Cache, cloudflare: CloudFlare, cache_ttl: float = 0) -> None:
     """
-    The main function of the program.
+    Synchronizes the firewall rules with the latest Cloudflare IP addresses.
 
     This function performs the following steps:
-    1. Initializes a cache using the FileCache class.
-    2. Initializes a CloudFlare object.
-    3. Retrieves the cached ETag from the cache.
-    4. Retrieves the latest IPv4 and IPv6 addresses from the CloudFlare API.
-    5. If the cached ETag is the same as the latest ETag, the function returns.
-    6. Initializes a firewall object using the Firewalld class.
-    7. If there is a cached ETag, retrieves the cached IPv4 and IPv6 addresses from the cache.
-    8. Removes the old allow rules from the firewall using the cached IPv4 and IPv6 addresses.
-    9. Adds new allow rules to the firewall using the latest IPv4 and IPv6 addresses.
-    10. Synchronizes the firewall rules.
-    11. Sets the latest ETag in the cache.
+    1. Refreshes the cache and, if it is younger than `cache_ttl` seconds, returns.
+    2. Retrieves the cached ETag from the cache.
+    3. Retrieves the latest IPv4 and IPv6 addresses from the CloudFlare API, sending the cached
+       ETag so that the request is conditional.
+    4. If the addresses did not change since the cached ETag, touches the cache to reset its age
+       and returns.
+    5. Initializes a firewall object using the create_firewall function.
+    6. Retrieves the IPv4 and IPv6 addresses currently allowed by the firewall and compares them
+       with the latest and the cached addresses. If none was added or dropped, skips to step 9.
+    7. Removes the allow rules of the cached addresses that are no longer in the latest addresses.
+    8. Adds allow rules for the latest addresses that are not allowed yet and synchronizes the
+       firewall rules.
+    9. Sets the latest ETag and addresses in the cache.
+    10. Writes the cache to disk.
+
+    Args:
+        cache (Cache): The cache holding the ETag and the addresses of the last synchronization.
+        cloudflare (CloudFlare): The CloudFlare API client.
+        cache_ttl (float): The number of seconds during which a synchronization is skipped after
+            the previous one (0 disables it).
 
     Returns:
         None
+    """
+    # The stored cache is checked for changes once, so the whole run sees a single version of it.
+    cache.refresh()
 
-    Example:
-        >>> main()
+    if cache_ttl > 0:
+        age = cache.get_age()
+
+        # The Cloudflare addresses rarely change, so a recent synchronization is trusted as is.
+        if age is not None and age < cache_ttl:
+            return
+
+    last_ips = cloudflare.get_ips(etag=cache.get_etag())
+
+    if last_ips is None:
+        cache.touch()
+        return
+
+    last_ips_v4, last_ips_v6, last_etag = last_ips
+
+    firewall = create_firewall()
+
+    # The firewall tells which addresses are missing, e.g. after manual edits or failed runs.
+    allowed_ips_v4 = firewall.get_allowed_ips(IPVersion.V4)
+    allowed_ips_v6 = firewall.get_allowed_ips(IPVersion.V6)
+
+    # Only the addresses allowed by a previous synchronization are removed, never the rules of
+    # the same shape that were added by other means. Rules that no longer exist are skipped by
+    # the firewall, in each of its configurations.
+    old_ips_v4 = cache.get_ipv4_addresses() - last_ips_v4
+    old_ips_v6 = cache.get_ipv6_addresses() - last_ips_v6
+    new_ips_v4, new_ips_v6 = last_ips_v4 - allowed_ips_v4, last_ips_v6 - allowed_ips_v6
+
+    # A new ETag does not imply new addresses (e.g. only their order changed).
+    if old_ips_v4 or old_ips_v6 or new_ips_v4 or new_ips_v6:
+        remove_old_allow_rules(old_ips_v4, old_ips_v6, firewall)
+        add_new_allow_rules(new_ips_v4, new_ips_v6, firewall)
+
+    cache.set_etag(last_etag)
+    cache.set_ipv4_addresses(last_ips_v4)
+    cache.set_ipv6_addresses(last_ips_v6)
+    cache.flush()
+
+
+def positive_seconds(value: str) -> float:
+    """
+    Parses a number of seconds given on the command line, which must be greater than 0.
+
+    Args:
+        value (str): The command line value.
+
+    Returns:
+        float: The number of seconds.
+
+    Raises:
+        ArgumentTypeError: If the value is not a finite number greater than 0.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+
+    if seconds is None or not isfinite(seconds) or seconds <= 0:
+        raise ArgumentTypeError(f"must be a number of seconds greater than 0, got {value!r}")
+
+    return seconds
+
+
+def watch(interval: float, cache_ttl: float = 0) -> None:
     """
+    Synchronizes the firewall rules every `interval` seconds, until interrupted.
+
+    The cache and the CloudFlare client are kept between synchronizations, so the HTTP connection
+    is reused and the process is only started once. Errors are printed to stderr and the next
+    synchronization is attempted after the interval.
 
+    Args:
+        interval (float): The number of seconds to wait between synchronizations.
+        cache_ttl (float): The number of seconds during which a synchronization is skipped after
+            the previous one (0 disables it).
+
+    Returns:
+        None
+    """
     cache: Cache = FileCache()
     cloudflare = CloudFlare()
 
-    cached_etag = cache.get("etag")
-    last_ips_v4, last_ips_v6, last_etag = cloudflare.get_ips()
+    while True:
+        try:
+            sync_cloudflare_ips(cache, cloudflare, cache_ttl)
+        except (OSError, HTTPException, SubprocessError) as error:
+            print(f"Synchronization failed: {error}", file=stderr)
 
-    if cached_etag == last_etag:
-        return
+        sleep(interval)
 
-    firewall: Firewall = Firewalld({443})
 
-    if cached_etag is not None:
-        cached_ipv4: set[str] = cache.get('ipv4')
-        cached_ipv6: set[str] = cache.get('ipv6')
+def main():
+    """
+    The main function of the program.
 
-        remove_old_allow_rules(cached_ipv4, cached_ipv6, firewall)
+    Synchronizes the firewall rules once, or periodically when the `--watch` option is given.
 
-    add_new_allow_rules(last_ips_v4, last_ips_v6, firewall)
+    Returns:
+        None
 
-    firewall.sync()
-    cache.set("etag", last_etag)
+    Example:
+        >>> main()
+    """
+    parser = ArgumentParser(
+        description="Synchronize firewall rules with the latest Cloudflare IP addresses.")
+    parser.add_argument(
+        "--watch", type=positive_seconds, metavar="SECONDS",
+        help="keep running and synchronize every SECONDS seconds")
+    args = parser.parse_args()
+
+    # The configuration is checked upfront: a firewall is only created once the addresses change.
+    try:
+        cache_ttl = get_cache_ttl()
+        get_firewall_backend()
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.watch is not None:
+        watch(args.watch, cache_ttl)
+    else:
+        sync_cloudflare_ips(FileCache(), CloudFlare(), cache_ttl)
 
 
 if __name__ == '__main__':